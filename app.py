@@ -1,17 +1,37 @@
 import os
-import json
-from dotenv import load_dotenv
+import io
+import re
+import orjson # Fast JSON parsing/serialization for the flowchart data
+import hashlib
+import time
+import threading
+import uuid
+from pathlib import Path
 import streamlit as st
-from openai import OpenAI
-import graphviz # Import the graphviz library for Python
-import streamlit.components.v1 as components # Keep for potential future use
+from openai import OpenAI, OpenAIError, DefaultHttpxClient
 
-# Load environment variables from a local .env file if present (helps local development)
-load_dotenv()
+# Load environment variables from a local .env file if present (helps local development).
+# dotenv is only imported when there is a file to load, so deployments skip it entirely.
+DOTENV_PATH = Path(__file__).parent / ".env"
+if DOTENV_PATH.exists():
+    from dotenv import load_dotenv
+    load_dotenv(DOTENV_PATH)
 
 # --------------------------
 # Setup OpenRouter client
 # --------------------------
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+@st.cache_resource
+def get_client():
+    # One process-wide client so its HTTP/2 connection pool (and TLS sessions) survive reruns
+    return OpenAI(
+        api_key=os.getenv("OPENROUTER_API_KEY"),
+        base_url=OPENROUTER_BASE_URL,
+        # DefaultHttpxClient keeps the SDK's own timeouts, redirect handling and connection limits
+        http_client=DefaultHttpxClient(http2=True)
+    )
+
 # IMPORTANT: Fetch OpenRouter API key from environment variables (secrets for deployment).
 try:
     openrouter_api_key = os.getenv("OPENROUTER_API_KEY")
@@ -19,10 +39,7 @@ try:
         st.error("❌ OpenRouter API key not found. Please set the OPENROUTER_API_KEY environment variable.")
         st.stop() # Stop the app if API key is not available
 
-    client = OpenAI(
-        api_key=openrouter_api_key,
-        base_url="https://openrouter.ai/api/v1"
-    )
+    client = get_client()
 except Exception as e:
     st.error(f"Failed to initialize OpenAI client. Please check your API key setup. Error: {e}")
     st.stop() # Stop the app if client cannot be initialized
@@ -58,27 +75,42 @@ code_input = st.text_area(
 # Model selection
 # --------------------------
 # Try to discover available models from the OpenRouter client so we don't select unavailable endpoints
-available_models = []
-try:
+@st.cache_data(ttl=3600, show_spinner=False)
+def list_models(api_key_hash):
+    # Returns {model_id: supports_json_mode}.
+    # Keyed on a hash of the API key (not the key itself) so reruns reuse the list without
+    # another round-trip and the secret never ends up in Streamlit's cache keys
     resp = client.models.list()
     # Support both dict-like and object-like responses
     data = getattr(resp, "data", None) or (resp.get("data") if isinstance(resp, dict) else None)
     if not data and isinstance(resp, list):
         data = resp
 
-    if data:
-        for m in data:
-            model_id = None
-            if isinstance(m, dict):
-                model_id = m.get("id") or m.get("model")
-            else:
-                model_id = getattr(m, "id", None) or getattr(m, "model", None)
-            if model_id:
-                available_models.append(model_id)
+    models = {}
+    for m in data or []:
+        model_id = None
+        if isinstance(m, dict):
+            model_id = m.get("id") or m.get("model")
+            supported_parameters = m.get("supported_parameters")
+        else:
+            model_id = getattr(m, "id", None) or getattr(m, "model", None)
+            supported_parameters = getattr(m, "supported_parameters", None)
+        if model_id:
+            # OpenRouter advertises JSON mode via "response_format" in each model's supported_parameters
+            models[model_id] = "response_format" in (supported_parameters or [])
+    if not models:
+        # Raise rather than return, so the empty list isn't cached and the next rerun fetches again
+        raise ValueError("OpenRouter returned no models")
+    return models
+
+model_json_support = {}
+try:
+    model_json_support = list_models(hashlib.sha256(openrouter_api_key.encode()).hexdigest())
 except Exception as e:
     # Don't fail the app on model discovery errors; we'll show defaults below and surface the warning
     st.warning(f"Could not fetch model list from OpenRouter: {e}")
 
+available_models = list(model_json_support)
 if not available_models:
     # Fallback: sensible defaults (may still be unavailable depending on OpenRouter account)
     available_models = [
@@ -89,6 +121,236 @@ if not available_models:
 
 model_choice = st.selectbox("AI Model (choose an available model):", available_models, index=0)
 
+# --------------------------
+# Response cache
+# --------------------------
+# Completions are memoized per (code, model) so re-generating the same snippet skips the LLM round-trip.
+# st.cache_data can't be used here: it replays UI writes on a cache hit and the explanation
+# streams into a placeholder created outside the call, so we keep a small TTL store instead,
+# backed by files on disk so cached responses survive restarts and are shared by all users.
+RESPONSE_CACHE_TTL = 3600 # Seconds an in-memory entry is kept before it is re-read from disk
+RESPONSE_CACHE_DIR = Path(__file__).parent / ".llm_cache"
+RESPONSE_CACHE_DISK_TTL = 7 * 24 * 3600 # Seconds before a cached completion is fetched again from the LLM
+RESPONSE_CACHE_MAX_FILES = 500 # Oldest files beyond this many are pruned on each write
+PROMPT_VERSION = "v3" # Bump whenever the prompt or response format changes to invalidate cached responses
+
+# Separates the flowchart JSON from the Markdown explanation in the combined response
+EXPLANATION_SENTINEL = "---EXPLANATION---"
+
+@st.cache_resource
+def _response_cache():
+    # Process-wide {key: (timestamp, text)} store, shared across reruns and sessions
+    return {}
+
+@st.cache_resource
+def _response_cache_lock():
+    # Sessions run in separate threads, so every access to the shared store holds this lock
+    return threading.Lock()
+
+def response_cache_key(code, model):
+    # One short hex digest per (prompt version, model, code); doubles as the cache file name
+    key_source = f"{PROMPT_VERSION}\0{model}\0{code}"
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+def get_cached_response(key):
+    with _response_cache_lock():
+        entry = _response_cache().get(key)
+    if entry and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+        return entry[1]
+    path = RESPONSE_CACHE_DIR / f"{key}.txt"
+    try:
+        if time.time() - path.stat().st_mtime >= RESPONSE_CACHE_DISK_TTL:
+            path.unlink(missing_ok=True)
+            return None
+        text = path.read_text(encoding="utf-8")
+    except OSError:
+        return None
+    with _response_cache_lock():
+        _response_cache()[key] = (time.monotonic(), text)
+    return text
+
+def cache_response(key, text):
+    cache = _response_cache()
+    now = time.monotonic()
+    with _response_cache_lock():
+        # Drop expired entries so the store doesn't grow without bound
+        for stale_key in [k for k, (ts, _) in cache.items() if now - ts >= RESPONSE_CACHE_TTL]:
+            del cache[stale_key]
+        cache[key] = (now, text)
+    try:
+        # Write to a temp file and rename so concurrent sessions never read a partial response
+        RESPONSE_CACHE_DIR.mkdir(exist_ok=True)
+        tmp_path = RESPONSE_CACHE_DIR / f"{key}.{uuid.uuid4().hex}.tmp"
+        tmp_path.write_text(text, encoding="utf-8")
+        os.replace(tmp_path, RESPONSE_CACHE_DIR / f"{key}.txt")
+        prune_response_files()
+    except OSError:
+        pass # The disk layer is best-effort; the in-memory cache still holds the response
+
+def prune_response_files():
+    # Remove expired files, then the oldest ones beyond RESPONSE_CACHE_MAX_FILES, so the
+    # directory stays bounded no matter how many different snippets users submit
+    files = []
+    now = time.time()
+    for path in RESPONSE_CACHE_DIR.iterdir():
+        try:
+            mtime = path.stat().st_mtime
+            if now - mtime >= RESPONSE_CACHE_DISK_TTL:
+                path.unlink(missing_ok=True)
+            elif path.suffix == ".txt":
+                files.append((mtime, path))
+        except OSError:
+            pass # Removed by another session in the meantime
+    files.sort(reverse=True)
+    for _, path in files[RESPONSE_CACHE_MAX_FILES:]:
+        path.unlink(missing_ok=True)
+
+# --------------------------
+# Flowchart JSON extraction
+# --------------------------
+def extract_json_object(text):
+    # Return the first complete top-level {...} object in the model output, found in a single
+    # left-to-right pass that tracks brace depth and skips braces inside JSON strings.
+    # Unlike slicing from the first '{' to the last '}', stray braces in trailing prose don't break it.
+    start = text.find("{")
+    if start == -1:
+        return text
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start : i + 1]
+    return text # Unbalanced output; let the JSON parser report the error
+
+def parse_flowchart(flowchart_output):
+    # Returns (graph_data, None) for a usable flowchart, or (None, error message) otherwise
+    try:
+        graph_data = orjson.loads(extract_json_object(flowchart_output))
+    except orjson.JSONDecodeError:
+        return None, "❌ The AI did not return valid JSON for the flowchart. Here is the raw output:"
+    if not (isinstance(graph_data, dict) and "nodes" in graph_data and "edges" in graph_data):
+        return None, "❌ Flowchart JSON missing 'nodes' or 'edges'. Raw output:"
+    return graph_data, None
+
+# --------------------------
+# Flowchart styling
+# --------------------------
+# Node styles, selected by keywords in the lowercased label
+DEFAULT_STYLE = {"shape": "box", "style": "filled", "fillcolor": "#1E90FF", "fontcolor": "white"} # Default blue
+START_STYLE = {**DEFAULT_STYLE, "fillcolor": "#32CD32", "shape": "oval"} # Green oval for start
+COND_STYLE = {**DEFAULT_STYLE, "fillcolor": "#FFD700", "shape": "diamond", "fontcolor": "black"} # Yellow diamond for conditions/loops
+END_STYLE = {**DEFAULT_STYLE, "fillcolor": "#8A2BE2", "shape": "oval"} # Purple oval for end/return
+CALL_STYLE = {**DEFAULT_STYLE, "fillcolor": "#FF6347"} # Red box for function calls
+INIT_STYLE = {**DEFAULT_STYLE, "fillcolor": "#ADD8E6", "fontcolor": "black"} # Light blue box for initialization/data
+
+# Checked in order, first match wins (so "Check if end reached" is a condition, not an end)
+STYLE_RULES = [
+    ("start", START_STYLE),
+    ("check", COND_STYLE), ("if", COND_STYLE), ("loop", COND_STYLE), ("condition", COND_STYLE),
+    ("return", END_STYLE), ("end", END_STYLE),
+    ("call", CALL_STYLE), ("function", CALL_STYLE),
+    ("initialize", INIT_STYLE), ("variable", INIT_STYLE), ("assign", INIT_STYLE),
+]
+
+# Edge colors: exact labels first, then keywords in the lowercased label (first match wins)
+DEFAULT_EDGE_COLOR = "#666666" # Gray
+EDGE_COLOR_EXACT = {"yes": "#32CD32", "no": "#FF6347"}
+EDGE_COLOR_RULES = [
+    ("true", "#32CD32"), # Green for 'Yes' paths
+    ("false", "#FF6347"), # Red for 'No' paths
+    ("iteration", "#0000FF"), ("loop", "#0000FF"), # Blue for loop paths
+]
+
+def node_style(label):
+    label_lower = label.lower()
+    return next((style for keyword, style in STYLE_RULES if keyword in label_lower), DEFAULT_STYLE)
+
+def edge_color(label):
+    label_lower = label.lower()
+    if label_lower in EDGE_COLOR_EXACT:
+        return EDGE_COLOR_EXACT[label_lower]
+    return next((color for keyword, color in EDGE_COLOR_RULES if keyword in label_lower), DEFAULT_EDGE_COLOR)
+
+UNESCAPED_QUOTE_RE = re.compile(r'(?<!\\)"')
+
+ORTHO_NODE_LIMIT = 40 # Flowcharts with at least this many nodes use cheaper polyline routing
+RENDER_CACHE_MAX_ENTRIES = 256 # Flowcharts whose rendering output is kept in memory (least recently used are evicted)
+
+def dot_quote(value):
+    # Quote a string for DOT the way the graphviz package does: escape bare double quotes and
+    # leave backslash sequences such as \n and \l alone so they still format labels
+    text = UNESCAPED_QUOTE_RE.sub(r'\\"', str(value))
+    # An odd run of trailing backslashes would escape the closing quote; pair off the last one
+    if (len(text) - len(text.rstrip("\\"))) % 2:
+        text += "\\"
+    return '"' + text + '"'
+
+def dot_attrs(attrs):
+    return " ".join(f"{key}={dot_quote(value)}" for key, value in attrs.items())
+
+@st.cache_data(show_spinner=False, max_entries=RENDER_CACHE_MAX_ENTRIES)
+def build_dot_source(graph_json):
+    # Keyed by the serialized flowchart, so regenerating the same flowchart reuses its DOT source.
+    # st.graphviz_chart lays the graph out in the browser, so the DOT source is all the server produces.
+    # The DOT text is written directly rather than through graphviz.Digraph, which quotes and
+    # formats every attribute through several layers of Python calls per node and edge.
+    graph_data = orjson.loads(graph_json)
+
+    # Don't trust the AI output: keep one node per id and drop edges to unknown ids,
+    # which Graphviz would otherwise render as extra empty nodes
+    # Ids are compared as strings, the same form they are rendered in (N_{id})
+    nodes = {str(node["id"]): node for node in graph_data["nodes"]}
+    edges = [edge for edge in graph_data["edges"] if str(edge["from"]) in nodes and str(edge["to"]) in nodes]
+
+    buf = io.StringIO()
+    buf.write("// Code Flowchart\ndigraph {\n")
+    if len(nodes) < ORTHO_NODE_LIMIT:
+        # Using 'ortho' splines for clearer, right-angle connections, and TB for Top-Bottom direction
+        buf.write("\tgraph [rankdir=TB splines=ortho]\n")
+    else:
+        # Large flowcharts: ortho routing scales poorly, so use polylines, merge parallel edges and
+        # cap the network-simplex and crossing-minimization passes to keep layout time bounded
+        buf.write("\tgraph [rankdir=TB splines=polyline concentrate=true nslimit=2.0 mclimit=0.5]\n")
+
+    # Add nodes to the diagram
+    for node in nodes.values():
+        node_id = dot_quote(f"N_{node['id']}") # Ensure IDs are unique strings
+        node_label = dot_quote(node["label"])
+        # Tooltip for hover effect (if supported by viewer)
+        buf.write(f"\t{node_id} [label={node_label} tooltip={node_label} {dot_attrs(node_style(node['label']))}]\n")
+
+    # Add edges to the diagram
+    for edge in edges:
+        label_text = edge.get("label", "")
+        edge_from = dot_quote(f"N_{edge['from']}")
+        edge_to = dot_quote(f"N_{edge['to']}")
+        # Thicker edges
+        buf.write(f"\t{edge_from} -> {edge_to} [label={dot_quote(label_text)} color={dot_quote(edge_color(label_text))} penwidth=2.0]\n")
+
+    buf.write("}\n")
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=RENDER_CACHE_MAX_ENTRIES)
+def pretty_json(graph_json, _graph_data):
+    # Indented JSON for the raw output expander, computed once per flowchart. graph_json is the
+    # cache key; the already-parsed _graph_data (underscore: not hashed) is dumped without re-parsing.
+    return orjson.dumps(_graph_data, option=orjson.OPT_INDENT_2).decode()
+
 # --------------------------
 # Generate Button
 # --------------------------
@@ -97,10 +359,17 @@ if st.button("Generate Diagram 🚀"):
         st.warning("Please paste some code first!")
     else:
         with st.spinner("Analyzing code and generating visualization..."):
-            # Prompt for Flowchart JSON
-            flowchart_prompt = f"""
-You are an expert developer assistant specialized in Data Structures and Algorithms (DSA) and code flow visualization.
-Analyze the following Python code and break it down into a **highly detailed, step-by-step flowchart representation**.
+            # The code goes in the system message so it forms a stable prompt prefix that providers can
+            # cache server-side; the task instructions below follow it as the user message
+            system_prompt = f"""You are a helpful assistant specialized in code analysis and visualization, and a programming tutor providing clear explanations.
+
+Here is the code:
+```python
+{code_input}
+```"""
+
+            # Flowchart instructions, shared by the combined prompt and the JSON-mode retry below
+            flowchart_instructions = """Analyze the Python code provided above and break it down into a **highly detailed, step-by-step flowchart representation**.
 Your goal is to make the logical flow, conditions, loops, and function calls **exceptionally clear and easy to understand for a student learning DSA**.
 
 **For each step, be as specific as possible.**
@@ -112,7 +381,7 @@ Your goal is to make the logical flow, conditions, loops, and function calls **e
 - **Return Statements:** Indicate what value is being returned.
 - **Variable State:** Briefly mention important variable state changes if they are critical to understanding the flow (e.g., "Increment counter", "Update sum").
 
-**Your output MUST be a JSON object with the following structure:**
+**The flowchart MUST be a JSON object with the following structure:**
   "nodes": a list of nodes, each with:
     - "id": a unique, short identifier (e.g., "S1", "C2", "L3")
     - "label": a concise, descriptive label for the step (e.g., "Check n <= 1", "Loop: for i in range(N)", "Return result")
@@ -121,43 +390,52 @@ Your goal is to make the logical flow, conditions, loops, and function calls **e
     - "to": the id of the target node
     - "label": optional, a short label for the connection (e.g., "Yes", "No", "Next Iteration")
 
-**IMPORTANT:**
-- Output ONLY JSON. Do not include any additional text, explanations, or markdown outside the JSON object.
-- Ensure the flow is comprehensive and captures all logical branches and iterations.
-
 **Example of a detailed JSON structure for a simple factorial function:**
-{{
+{
   "nodes": [
-    {{"id": "A", "label": "Start: factorial(n)"}},
-    {{"id": "B", "label": "Check if n <= 1"}},
-    {{"id": "C", "label": "Return 1 (Base Case)"}},
-    {{"id": "D", "label": "Calculate n-1"}},
-    {{"id": "E", "label": "Recursive Call: factorial(n-1)"}},
-    {{"id": "F", "label": "Multiply n * result_from_recursion"}},
-    {{"id": "G", "label": "Return final result"}},
-    {{"id": "H", "label": "End"}}
+    {"id": "A", "label": "Start: factorial(n)"},
+    {"id": "B", "label": "Check if n <= 1"},
+    {"id": "C", "label": "Return 1 (Base Case)"},
+    {"id": "D", "label": "Calculate n-1"},
+    {"id": "E", "label": "Recursive Call: factorial(n-1)"},
+    {"id": "F", "label": "Multiply n * result_from_recursion"},
+    {"id": "G", "label": "Return final result"},
+    {"id": "H", "label": "End"}
   ],
   "edges": [
-    {{"from": "A", "to": "B"}},
-    {{"from": "B", "to": "C", "label": "Yes"}},
-    {{"from": "B", "to": "D", "label": "No"}},
-    {{"from": "C", "to": "H"}},
-    {{"from": "D", "to": "E"}},
-    {{"from": "E", "to": "F"}},
-    {{"from": "F", "to": "G"}},
-    {{"from": "G", "to": "H"}}
+    {"from": "A", "to": "B"},
+    {"from": "B", "to": "C", "label": "Yes"},
+    {"from": "B", "to": "D", "label": "No"},
+    {"from": "C", "to": "H"},
+    {"from": "D", "to": "E"},
+    {"from": "E", "to": "F"},
+    {"from": "F", "to": "G"},
+    {"from": "G", "to": "H"}
   ]
-}}
+}"""
 
-Here is the code:
-```python
-{code_input}
+            # Flowchart-only prompt for a JSON-mode retry when the combined response's JSON doesn't parse
+            flowchart_retry_prompt = f"""
+You are an expert developer assistant specialized in Data Structures and Algorithms (DSA) and code flow visualization.
+
+{flowchart_instructions}
+
+**IMPORTANT:**
+- Output ONLY the flowchart JSON object.
+- Ensure the flow is comprehensive and captures all logical branches and iterations.
 """
-            
-            # Prompt for Code Explanation - ENHANCED FOR DEEPER UNDERSTANDING AND CREATIVE LEARNING
-            code_explanation_prompt = f"""
-You are an expert programming tutor, specializing in Data Structures and Algorithms (DSA).
-Explain the following Python code in a clear, concise, and easy-to-understand manner for a student.
+
+            # Single prompt for both the Flowchart JSON and the Code Explanation, so the code is only
+            # sent (and billed) once and the results arrive in one round-trip
+            combined_prompt = f"""
+You are an expert developer assistant and programming tutor specialized in Data Structures and Algorithms (DSA) and code flow visualization.
+Your answer has two parts: a flowchart JSON object, then a student-friendly explanation of the code.
+
+**PART 1 - Flowchart JSON**
+{flowchart_instructions}
+
+**PART 2 - Code Explanation**
+Explain the code in a clear, concise, and easy-to-understand manner for a student.
 Go beyond just describing what each line does. Focus on:
 
 1.  **Purpose and "Why":** Explain *why* certain lines or blocks of code are necessary. What problem does this specific part solve, or what role does it play in the overall logic?
@@ -174,143 +452,114 @@ Present the explanation using Markdown for clear formatting.
 Keep the overall explanation student-friendly and aim for clarity over exhaustive detail.
 Limit the explanation to a maximum of 400 words to keep it digestible.
 
-Here is the code:
-```python
-{code_input}
-```
+**IMPORTANT - Output format:**
+- First output ONLY the flowchart JSON object, with no markdown fences or other text around it.
+- Then output a line containing exactly `{EXPLANATION_SENTINEL}`.
+- Then output the Markdown explanation.
+- Ensure the flow is comprehensive and captures all logical branches and iterations.
 """
 
             try:
-                # Get Flowchart JSON from AI
-                flowchart_response = client.chat.completions.create(
-                    model=model_choice,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant specialized in code analysis and visualization, outputting only valid JSON."},
-                        {"role": "user", "content": flowchart_prompt}
-                    ],
-                    temperature=0.3
-                )
-                flowchart_output = flowchart_response.choices[0].message.content.strip()
-
-                # Get Code Explanation from AI
-                explanation_response = client.chat.completions.create(
-                    model=model_choice,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful programming tutor, providing clear explanations."},
-                        {"role": "user", "content": code_explanation_prompt}
-                    ],
-                    temperature=0.3
-                )
-                code_explanation = explanation_response.choices[0].message.content.strip()
-
-
-                # Attempt to extract only the JSON part from the flowchart output
-                json_start = flowchart_output.find('{')
-                json_end = flowchart_output.rfind('}')
-
-                if json_start != -1 and json_end != -1 and json_end > json_start:
-                    json_string = flowchart_output[json_start : json_end + 1]
+                # Lay out the results up front so the explanation can stream into place
+                # while the rest of the response is still arriving
+                col1, col2, col3 = st.columns([1, 4, 1]) # Center the graph using Streamlit columns
+                st.markdown("---")
+                st.subheader("Code Explanation")
+                explanation_placeholder = st.empty()
+
+                response_key = response_cache_key(code_input, model_choice)
+                response_output = get_cached_response(response_key)
+                cached = response_output is not None
+
+                if not cached:
+                    # Get Flowchart JSON and Code Explanation from AI in one streamed completion.
+                    # This call deliberately never sends response_format: JSON mode only allows a single JSON
+                    # object, which would force the Markdown explanation into an escaped JSON string and stop
+                    # it from streaming. JSON mode is used only for the flowchart-only retry below.
+                    stream = client.chat.completions.create(
+                        model=model_choice,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": combined_prompt}
+                        ],
+                        temperature=0.3,
+                        stream=True
+                    )
+                    response_output = ""
+                    explanation_start = -1
+                    for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        # Only the new tail (plus a sentinel-length overlap) needs scanning for the sentinel
+                        search_from = max(0, len(response_output) - len(EXPLANATION_SENTINEL))
+                        response_output += chunk.choices[0].delta.content or ""
+                        # The JSON comes first; once the sentinel has arrived, stream the explanation as it grows
+                        if explanation_start == -1:
+                            sentinel_pos = response_output.find(EXPLANATION_SENTINEL, search_from)
+                            if sentinel_pos != -1:
+                                explanation_start = sentinel_pos + len(EXPLANATION_SENTINEL)
+                        if explanation_start != -1:
+                            explanation_placeholder.markdown(response_output[explanation_start:])
+
+                flowchart_output, sentinel, code_explanation = response_output.partition(EXPLANATION_SENTINEL)
+                flowchart_output = flowchart_output.strip()
+                code_explanation = code_explanation.strip()
+                if not sentinel:
+                    # The model skipped the sentinel line; treat whatever follows the JSON object as the explanation
+                    # (when no object is found, json_part is the whole text and nothing follows it)
+                    json_part = extract_json_object(flowchart_output)
+                    code_explanation = flowchart_output[flowchart_output.find(json_part) + len(json_part):].strip()
+                if code_explanation:
+                    explanation_placeholder.markdown(code_explanation) # Display the AI-generated code explanation
                 else:
-                    json_string = flowchart_output
-
-                # Attempt to parse JSON
-                try:
-                    graph_data = json.loads(json_string)
-                except json.JSONDecodeError:
-                    st.error("❌ The AI did not return valid JSON for the flowchart. Here is the raw output:")
+                    explanation_placeholder.warning("⚠️ The AI did not return an explanation for this code. Try generating again or choose another model.")
+
+                graph_data, flowchart_error = parse_flowchart(flowchart_output)
+
+                if flowchart_error and model_json_support.get(model_choice, False):
+                    # The flowchart didn't parse; ask again for the flowchart alone in JSON mode, where the
+                    # server guarantees valid JSON. require_parameters makes OpenRouter route only to
+                    # providers that honour response_format.
+                    try:
+                        retry_response = client.chat.completions.create(
+                            model=model_choice,
+                            messages=[
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": flowchart_retry_prompt}
+                            ],
+                            temperature=0.3,
+                            response_format={"type": "json_object"},
+                            extra_body={"provider": {"require_parameters": True}}
+                        )
+                    except OpenAIError:
+                        # e.g. no endpoint supports the required parameters, or a transient API error:
+                        # keep the original output so the error below shows what the model returned
+                        pass
+                    else:
+                        flowchart_output = (retry_response.choices[0].message.content or "").strip()
+                        graph_data, flowchart_error = parse_flowchart(flowchart_output)
+
+                if flowchart_error:
+                    st.error(flowchart_error)
                     st.code(flowchart_output)
                     st.stop()
 
-                # Validate keys
-                if not ("nodes" in graph_data and "edges" in graph_data):
-                    st.error("❌ Flowchart JSON missing 'nodes' or 'edges'. Raw output:")
-                    st.code(flowchart_output)
-                    st.stop()
+                # Only remember complete responses (a flowchart that parsed plus an explanation after the
+                # sentinel), so an incomplete one is fetched again rather than persisted. The flowchart is
+                # stored as parsed, so a JSON-mode retry's result is what gets reused.
+                if not cached and sentinel and code_explanation:
+                    cache_response(response_key, f"{flowchart_output}\n{EXPLANATION_SENTINEL}\n{code_explanation}")
 
                 # --- START: Graphviz Generation ---
-                # Create a Digraph object
-                # Using 'ortho' splines for clearer, right-angle connections, and TB for Top-Bottom direction
-                dot = graphviz.Digraph(comment='Code Flowchart', graph_attr={'rankdir': 'TB', 'splines': 'ortho'})
-
-                # Add nodes to the Graphviz diagram
-                for node in graph_data["nodes"]:
-                    node_id = f"N_{node['id']}" # Ensure IDs are unique strings
-                    node_label = node["label"]
-                    
-                    # Default styles
-                    shape = "box"
-                    fillcolor = "#1E90FF" # Default blue
-                    fontcolor = "white"
-                    style = "filled"
-
-                    # Apply specific styling based on label content
-                    if "start" in node_label.lower():
-                        fillcolor = "#32CD32" # Green for start
-                        shape = "oval" # Oval for start/end
-                    elif "check" in node_label.lower() or "if" in node_label.lower() or "loop" in node_label.lower() or "condition" in node_label.lower():
-                        fillcolor = "#FFD700" # Yellow for conditions/loops
-                        shape = "diamond" # Diamond for decisions
-                        fontcolor = "black" # Black text for yellow background
-                    elif "return" in node_label.lower() or "end" in node_label.lower():
-                        fillcolor = "#8A2BE2" # Purple for end/return
-                        shape = "oval" # Oval for start/end
-                    elif "call" in node_label.lower() or "function" in node_label.lower():
-                        fillcolor = "#FF6347" # Red for function calls
-                        shape = "box" # Box for processes (or perhaps a rounded box for subroutines)
-                    elif "initialize" in node_label.lower() or "variable" in node_label.lower() or "assign" in node_label.lower():
-                        fillcolor = "#ADD8E6" # Light blue for initialization/data
-                        fontcolor = "black"
-                        shape = "box" # Process box
-
-                    dot.node(
-                        node_id,
-                        label=node_label,
-                        shape=shape,
-                        style=style,
-                        fillcolor=fillcolor,
-                        fontcolor=fontcolor,
-                        tooltip=node_label # Tooltip for hover effect (if supported by viewer)
-                    )
-
-                # Add edges to the Graphviz diagram
-                for edge in graph_data["edges"]:
-                    edge_from_prefixed = f"N_{edge['from']}"
-                    edge_to_prefixed = f"N_{edge['to']}"
-                    label_text = edge.get("label", "")
-                    
-                    # Default edge color
-                    edge_color = "#666666" # Gray
-
-                    if label_text.lower() == "yes" or "true" in label_text.lower():
-                        edge_color = "#32CD32" # Green for 'Yes' paths
-                    elif label_text.lower() == "no" or "false" in label_text.lower():
-                        edge_color = "#FF6347" # Red for 'No' paths
-                    elif "iteration" in label_text.lower() or "loop" in label_text.lower():
-                        edge_color = "#0000FF" # Blue for loop paths
-                        
-                    dot.edge(
-                        edge_from_prefixed,
-                        edge_to_prefixed,
-                        label=label_text,
-                        color=edge_color,
-                        penwidth="2.0" # Thicker edges
-                    )
-
-                # Center the graph using Streamlit columns
-                col1, col2, col3 = st.columns([1, 4, 1])
+                graph_json = orjson.dumps(graph_data) # Cache key for the DOT source and raw JSON view
                 with col2:
-                    st.graphviz_chart(dot)
-
-                # Add explanation for the flowchart (now for the code itself)
-                st.markdown("---")
-                st.subheader("Code Explanation")
-                st.write(code_explanation) # Display the AI-generated code explanation
+                    st.graphviz_chart(build_dot_source(graph_json))
 
                 # --- END: Graphviz Generation ---
 
                 # Show raw JSON
                 with st.expander("🔍 Raw JSON output"):
-                    st.code(json.dumps(graph_data, indent=2))
+                    st.code(pretty_json(graph_json, graph_data))
 
             except Exception as e:
                 st.error(f"❌ An error occurred during diagram generation: {str(e)}")